@@ -43,18 +43,19 @@ class Arb(object):
                     aligned_seq):
         """Write out ARB record for genome."""
 
-        fout.write("BEGIN\n")
-        fout.write("db_name=%s\n" % genome_id)
+        record = ['BEGIN', 'db_name=%s' % genome_id]
         for col_header, value in zip(metadata_fields, metadata_values):
             # replace equal signs as these are incompatible with the ARB parser
             if value:
                 value = value.replace('=', '/')
 
-            fout.write("%s=%s\n" % (col_header, value))
+            record.append('%s=%s' % (col_header, value))
         
-        fout.write("warning=\n")
-        fout.write("aligned_seq=%s\n" % (aligned_seq))
-        fout.write("END\n\n")
+        record.append('warning=')
+        record.append('aligned_seq=%s' % aligned_seq)
+        record.append('END\n\n')
+
+        fout.write('\n'.join(record))
 
     def create_records(self, metadata_file, msa_file, taxonomy_file, genome_list, output_file):
         """Create ARB records from GTDB metadata."""
@@ -79,7 +80,7 @@ class Arb(object):
             delimiter = '\t'
         
         header = True
-        for row in csv.reader(open(metadata_file, 'rb'), delimiter=delimiter):
+        for row in csv.reader(open(metadata_file), delimiter=delimiter):
             if header:
                 fields = [f.lower().replace(' ', '_').replace('-', '_') for f in row[1:]]
                 if taxonomy:
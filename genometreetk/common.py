@@ -18,7 +18,13 @@
 import os
 import csv
 import sys
+import hashlib
+import logging
+import tempfile
+import subprocess
 from collections import defaultdict, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 
 import biolib.seq_io as seq_io
 from biolib.taxonomy import Taxonomy
@@ -125,7 +131,7 @@ def filter_genomes(metadata_file,
     
     genome_ids = set()
 
-    csv_reader = csv.reader(open(metadata_file, 'rb'))
+    csv_reader = csv.reader(open(metadata_file))
     bHeader = True
     for row in csv_reader:
         if bHeader:
@@ -446,7 +452,7 @@ def read_gtdb_taxonomy(metadata_file):
             taxa_str = line_split[taxonomy_index].strip()
 
             if taxa_str and taxa_str != 'none':
-                taxonomy[genome_id] = map(str.strip, taxa_str.split(';'))
+                taxonomy[genome_id] = [t.strip() for t in taxa_str.split(';')]
             else:
                 taxonomy[genome_id] = list(Taxonomy.rank_prefixes)
 
@@ -508,7 +514,7 @@ def read_gtdb_ncbi_taxonomy(metadata_file, species_exception_file):
             taxa_str = taxa_str.replace('Candidatus ', '')
 
             if taxa_str and taxa_str != 'none':
-                taxonomy[genome_id] = map(str.strip, taxa_str.split(';'))
+                taxonomy[genome_id] = [t.strip() for t in taxa_str.split(';')]
             else:
                 taxonomy[genome_id] = list(Taxonomy.rank_prefixes)
     
@@ -651,6 +657,210 @@ def read_marker_id_file(marker_id_file):
     return marker_genes
 
 
+def read_pfam_model_names(pfam_model_file):
+    """Read name of each model in a Pfam HMM file.
+
+    Only the NAME and ACC header lines are of interest so lines
+    are tested by prefix rather than searched in their entirety.
+
+    Parameters
+    ----------
+    pfam_model_file : str
+        File containing Pfam HMMs.
+
+    Returns
+    -------
+    dict : d[accession] -> name
+        Name of each Pfam model.
+    """
+
+    marker_id_to_name = {}
+    with open(pfam_model_file) as f:
+        for line in f:
+            if line.startswith('NAME '):
+                name = line.split()[1]
+            elif line.startswith('ACC '):
+                marker_id_to_name[line.split()[1]] = name
+
+    return marker_id_to_name
+
+
+def read_tophit_genes(genome_dir, extensions):
+    """Read genes hit by each protein family from top hit files of a genome.
+
+    Parameters
+    ----------
+    genome_dir : str
+        Directory containing files for genome.
+    extensions : iterable
+        Extensions of top hit files to read (e.g., Pfam and TIGRFAMs).
+
+    Returns
+    -------
+    dict : d[family_id] -> [(gene_id_1, bitscore), ..., (gene_id_N, bitscore)]
+        Genes within genome.
+
+    Raises
+    ------
+    ValueError
+        If a hit is not of the form <family_id>,<evalue>,<bitscore>.
+    """
+
+    assembly = genome_dir[genome_dir.rfind('/') + 1:]
+
+    marker_id_to_gene_id = defaultdict(list)
+    for extension in extensions:
+        tophit_file = os.path.join(genome_dir, assembly + extension)
+
+        with open(tophit_file) as f:
+            f.readline()
+
+            for line in f:
+                gene_id, _, hits = line.partition('\t')
+                for hit in hits.split(';'):
+                    # hits have the form <family_id>,<evalue>,<bitscore>
+                    protein_family, sep, scores = hit.partition(',')
+                    _, score_sep, bitscore = scores.rpartition(',')
+                    if not sep or not score_sep:
+                        raise ValueError('Malformed hit in %s: %s' % (tophit_file, hit.strip()))
+
+                    marker_id_to_gene_id[protein_family].append((gene_id, float(bitscore)))
+
+    return marker_id_to_gene_id
+
+
+def fetch_tigrfam_model(marker_id, tigrfams_model_dir, output_model_dir):
+    """Save TIGRFAMs marker gene into an individual model file.
+
+    Parameters
+    ----------
+    marker_id : str
+        TIGRFAMs marker gene to fetch.
+    tigrfams_model_dir : str
+        Directory containing TIGRFAMs HMMs.
+    output_model_dir : str
+        Directory to write HMM model file.
+
+    Raises
+    ------
+    subprocess.CalledProcessError
+        If hmmfetch fails to fetch the model.
+    """
+
+    model_file = os.path.join(tigrfams_model_dir, marker_id + '.HMM')
+    with open(os.path.join(output_model_dir, marker_id + '.hmm'), 'w') as fout:
+        subprocess.check_call(['hmmfetch', model_file, marker_id], stdout=fout)
+
+
+def fetch_marker_models(marker_genes, pfam_model_file, tigrfams_model_dir, output_model_dir, cpus=1):
+    """Save Pfam and TIGRFAMs marker genes into individual model files.
+
+    All Pfam models are retrieved with a single call to hmmfetch
+    using a key file and the output split into individual models. This
+    avoids rescanning the Pfam database for each marker gene. TIGRFAMs
+    models are stored in individual files and are fetched concurrently.
+
+    Parameters
+    ----------
+    marker_genes : iterable
+        Marker genes to fetch.
+    pfam_model_file : str
+        File containing Pfam HMMs.
+    tigrfams_model_dir : str
+        Directory containing TIGRFAMs HMMs.
+    output_model_dir : str
+        Directory to write individual HMM model files.
+    cpus : int
+        Number of TIGRFAMs models to fetch concurrently.
+    """
+
+    pfam_markers = [marker_id for marker_id in marker_genes if marker_id.startswith('PF')]
+    tigr_markers = [marker_id for marker_id in marker_genes if not marker_id.startswith('PF')]
+
+    if pfam_markers:
+        logger = logging.getLogger()
+
+        marker_id_to_name = read_pfam_model_names(pfam_model_file)
+        unknown_markers = [marker_id for marker_id in pfam_markers if marker_id not in marker_id_to_name]
+        if unknown_markers:
+            logger.error('Pfam models not found in %s: %s' % (pfam_model_file, ', '.join(sorted(unknown_markers))))
+            sys.exit(-1)
+
+        with tempfile.NamedTemporaryFile('w', suffix='.keys', delete=False) as f:
+            key_file = f.name
+            for marker_id in pfam_markers:
+                f.write(marker_id_to_name[marker_id] + '\n')
+
+        try:
+            proc = subprocess.Popen(['hmmfetch', '-f', pfam_model_file, key_file],
+                                    stdout=subprocess.PIPE,
+                                    universal_newlines=True)
+
+            model = []
+            fetched_markers = set()
+            for line in proc.stdout:
+                model.append(line)
+                if line.startswith('ACC '):
+                    marker_id = line.split()[1]
+                elif line.startswith('//'):
+                    with open(os.path.join(output_model_dir, marker_id + '.hmm'), 'w') as fout:
+                        fout.write(''.join(model))
+                    fetched_markers.add(marker_id)
+                    model = []
+
+            proc.wait()
+        finally:
+            os.remove(key_file)
+
+        if proc.returncode != 0:
+            logger.error('hmmfetch failed with return code %d while fetching Pfam models.' % proc.returncode)
+            sys.exit(-1)
+
+        missing_markers = set(pfam_markers) - fetched_markers
+        if missing_markers:
+            logger.error('Failed to fetch %d Pfam models: %s' % (len(missing_markers), ', '.join(sorted(missing_markers))))
+            sys.exit(-1)
+
+    # hmmfetch runs in a separate process so threads are sufficient
+    # to fetch models in parallel; results are iterated so any failed
+    # fetch is raised to the caller
+    fetch_model = partial(fetch_tigrfam_model,
+                            tigrfams_model_dir=tigrfams_model_dir,
+                            output_model_dir=output_model_dir)
+    with ThreadPoolExecutor(max_workers=cpus) as executor:
+        for _ in executor.map(fetch_model, tigr_markers):
+            pass
+
+
+def replicate_signature(input_files, params):
+    """Calculate signature of inputs used to infer replicate trees.
+
+    Parameters
+    ----------
+    input_files : iterable
+        Files used to infer replicate trees.
+    params : iterable
+        Parameters used to infer replicate trees.
+
+    Returns
+    -------
+    str
+        Hex digest identifying input files and parameters.
+    """
+
+    signature = hashlib.sha256()
+    for input_file in input_files:
+        with open(input_file, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                signature.update(block)
+        signature.update(b'\0')
+
+    for param in params:
+        signature.update(str(param).encode() + b'\0')
+
+    return signature.hexdigest()
+
+
 def read_genome_id_file(genome_id_file):
     """Read genome ids from file.
 
@@ -686,6 +896,38 @@ def read_genome_id_file(genome_id_file):
     return ncbi_genome_ids, user_genome_ids
 
 
+def subtree_leaf_ranges(tree):
+    """Determine leaves below each node with a single postorder traversal.
+
+    Leaves are listed in the order they are visited so the leaves
+    of any subtree form a contiguous block of this list.
+
+    Parameters
+    ----------
+    tree : dendropy.Tree
+        Tree to process.
+
+    Returns
+    -------
+    list
+        Label of each leaf node in postorder.
+    dict : d[node] -> (start, end)
+        Slice of leaf labels contained in the subtree of each node.
+    """
+
+    leaf_labels = []
+    leaf_ranges = {}
+    for node in tree.postorder_node_iter():
+        if node.is_leaf():
+            leaf_labels.append(node.taxon.label)
+            leaf_ranges[node] = (len(leaf_labels) - 1, len(leaf_labels))
+        else:
+            children = node.child_nodes()
+            leaf_ranges[node] = (leaf_ranges[children[0]][0], leaf_ranges[children[-1]][1])
+
+    return leaf_labels, leaf_ranges
+
+
 def create_concatenated_alignment(genome_ids,
                                    marker_genes,
                                    alignment_dir,
@@ -730,18 +972,19 @@ def create_concatenated_alignment(genome_ids,
         fout.write('%s\t%s\t%s\t%d\n' % (mg, mg, mg, marker_length[mg]))
     fout.close()
 
-    # create concatenated alignment
-    concatenated_seqs = {}
+    # create concatenated alignment, collecting the aligned
+    # sequence of each marker so each genome is only joined once
+    concatenated_seqs = defaultdict(list)
     for mg in marker_genes:
         seqs = alignments[mg]
+        missing_gene = '-' * marker_length[mg]
 
         for genome_id in genome_ids:
-            if genome_id in seqs:
-                # append alignment
-                concatenated_seqs[genome_id] = concatenated_seqs.get(genome_id, '') + seqs[genome_id]
-            else:
-                # missing gene
-                concatenated_seqs[genome_id] = concatenated_seqs.get(genome_id, '') + '-' * marker_length[mg]
+            # append alignment or gaps for missing gene
+            concatenated_seqs[genome_id].append(seqs.get(genome_id, missing_gene))
+
+    for genome_id, seq_list in concatenated_seqs.items():
+        concatenated_seqs[genome_id] = ''.join(seq_list)
 
     # save concatenated alignment
     seq_io.write_fasta(concatenated_seqs, concatenated_alignment_file)
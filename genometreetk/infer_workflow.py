@@ -16,6 +16,7 @@
 ###############################################################################
 
 import os
+import shutil
 import logging
 
 from biolib.common import make_sure_path_exists
@@ -26,6 +27,7 @@ from biolib.external.fasttree import FastTree
 from genometreetk.common import (read_genome_id_file,
                                     read_genome_dir_file,
                                     read_marker_id_file,
+                                    fetch_marker_models,
                                     create_concatenated_alignment)
 from genometreetk.markers.align_markers import AlignMarkers
 
@@ -71,26 +73,15 @@ class InferWorkflow(object):
             Directory to write individual HMM model files.
         """
 
-        marker_id_to_name = {}
-        for line in open(self.pfam_model_file):
-            if 'NAME' in line:
-                name = line.split()[1].rstrip()
-            elif 'ACC' in line:
-                acc = line.split()[1].rstrip()
-                marker_id_to_name[acc] = name
+        fetch_marker_models(marker_genes, self.pfam_model_file, self.tigrfams_model_dir, output_model_dir, self.cpus)
 
         fout_model = open(hmm_model_out, 'w')
         for marker_id in marker_genes:
             output_model_file = os.path.join(output_model_dir, marker_id + '.hmm')
-            if 'PF' in marker_id:
-                os.system('hmmfetch ' + self.pfam_model_file + ' ' + marker_id_to_name[marker_id] + ' > ' + output_model_file)
-            else:
-                input_model_file = os.path.join(self.tigrfams_model_dir, marker_id + '.HMM')
-                os.system('hmmfetch ' + input_model_file + ' ' + marker_id + ' > ' + output_model_file)
 
             # write model to file
-            for line in open(output_model_file):
-                fout_model.write(line)
+            with open(output_model_file) as fin:
+                shutil.copyfileobj(fin, fout_model)
 
         fout_model.close()
 
@@ -27,6 +27,8 @@ from biolib.common import remove_extension, make_sure_path_exists
 from biolib.external.fasttree import FastTree
 from biolib.parallel import Parallel
 
+from genometreetk.common import replicate_signature
+
 
 class JackknifeMarkers(object):
     """Assess robustness by jackkifing genes in alignment."""
@@ -54,12 +56,31 @@ class JackknifeMarkers(object):
         """
 
         output_msa = os.path.join(self.replicate_dir, 'jk_markers.msa.' + str(replicated_num) + '.faa')
-        self.jackknife_alignment(self.msa, self.perc_markers_to_keep, self.marker_lengths, output_msa)
-
-        fast_tree = FastTree(multithreaded=False)
         output_tree = os.path.join(self.replicate_dir, 'jk_markers.tree.' + str(replicated_num) + '.tre')
         fast_tree_output = os.path.join(self.replicate_dir, 'jk_markers.fasttree.' + str(replicated_num) + '.out')
-        fast_tree.run(output_msa, 'prot', self.model, output_tree, fast_tree_output)
+        signature_file = output_tree + '.signature'
+
+        # reuse replicate only if it was inferred from the same inputs
+        # and parameters; trees are written to a temporary file so
+        # a partial tree from an interrupted run is never reused
+        signature = None
+        if os.path.exists(output_tree) and os.path.exists(signature_file):
+            with open(signature_file) as f:
+                signature = f.read().strip()
+
+        if signature == self.signature:
+            self.logger.warning('Skipping {} as it already exists.'.format(output_tree))
+        else:
+            self.jackknife_alignment(self.msa, self.perc_markers_to_keep, self.marker_lengths, output_msa)
+
+            tmp_tree = output_tree + '.tmp'
+            fast_tree = FastTree(multithreaded=False)
+            fast_tree.run(output_msa, 'prot', self.model, tmp_tree, fast_tree_output)
+
+            if os.path.exists(tmp_tree) and os.path.getsize(tmp_tree) > 0:
+                os.replace(tmp_tree, output_tree)
+                with open(signature_file, 'w') as f:
+                    f.write(self.signature + '\n')
 
         return True
 
@@ -91,16 +112,21 @@ class JackknifeMarkers(object):
         for index, ml in enumerate(marker_lengths):
             start_pos.append(start_pos[index] + ml)
 
-        mask = [0] * sum(marker_lengths)
-        for marker_index in markers_to_keep:
+        # retained columns form one contiguous block per marker so
+        # sequences can be subsampled by slicing instead of per column
+        blocks = []
+        for marker_index in sorted(markers_to_keep):
             start = start_pos[marker_index]
             end = start + marker_lengths[marker_index]
-            mask[start:end] = [1] * (end - start)
+            if blocks and blocks[-1][1] == start:
+                blocks[-1][1] = end
+            else:
+                blocks.append([start, end])
 
         fout = open(output_file, 'w')
         for seq_id, seq in msa.items():
             fout.write('>' + seq_id + '\n')
-            sub_seq = ''.join([base for base, m in zip(seq, mask) if m == 1])
+            sub_seq = ''.join([seq[start:end] for start, end in blocks])
             fout.write(sub_seq + '\n')
         fout.close()
 
@@ -179,6 +205,8 @@ class JackknifeMarkers(object):
 
             # read full multiple sequence alignment
             self.msa = seq_io.read(msa_file)
+            self.signature = replicate_signature([msa_file, marker_info_file, mask_file],
+                                                    [perc_markers_to_keep, model])
             
             if len(list(self.msa.values())[0]) != total_mask_len:
                 self.logger.error('Length of MSA does not meet length of mask.')
@@ -26,6 +26,7 @@ from biolib.parallel import Parallel
 from biolib.bootstrap import bootstrap_support
 from biolib.common import remove_extension, make_sure_path_exists
 
+from genometreetk.common import replicate_signature
 from genometreetk.tree_support import TreeSupport
 
 
@@ -55,12 +56,31 @@ class JackknifeTaxa(object):
         """
 
         output_msa = os.path.join(self.replicate_dir, 'jk_taxa.msa.' + str(replicated_num) + '.fna')
-        self.jackknife_taxa(self.msa, self.perc_taxa_to_keep, self.outgroup_ids, output_msa)
-
-        fast_tree = FastTree(multithreaded=False)
         output_tree = os.path.join(self.replicate_dir, 'jk_taxa.tree.' + str(replicated_num) + '.tre')
         fast_tree_output = os.path.join(self.replicate_dir, 'jk_taxa.fasttree.' + str(replicated_num) + '.out')
-        fast_tree.run(output_msa, 'prot', self.model, output_tree, fast_tree_output)
+        signature_file = output_tree + '.signature'
+
+        # reuse replicate only if it was inferred from the same inputs
+        # and parameters; trees are written to a temporary file so
+        # a partial tree from an interrupted run is never reused
+        signature = None
+        if os.path.exists(output_tree) and os.path.exists(signature_file):
+            with open(signature_file) as f:
+                signature = f.read().strip()
+
+        if signature == self.signature:
+            self.logger.warning('Skipping {} as it already exists.'.format(output_tree))
+        else:
+            self.jackknife_taxa(self.msa, self.perc_taxa_to_keep, self.outgroup_ids, output_msa)
+
+            tmp_tree = output_tree + '.tmp'
+            fast_tree = FastTree(multithreaded=False)
+            fast_tree.run(output_msa, 'prot', self.model, tmp_tree, fast_tree_output)
+
+            if os.path.exists(tmp_tree) and os.path.getsize(tmp_tree) > 0:
+                os.replace(tmp_tree, output_tree)
+                with open(signature_file, 'w') as f:
+                    f.write(self.signature + '\n')
 
         return True
 
@@ -86,7 +106,7 @@ class JackknifeTaxa(object):
 
         # randomly select ingroup taxa
         ingroup_taxa = set(msa.keys()) - outgroup_ids
-        taxa_to_keep = random.sample(ingroup_taxa, int(floor(len(ingroup_taxa) * perc_taxa_to_keep)))
+        taxa_to_keep = random.sample(list(ingroup_taxa), int(floor(len(ingroup_taxa) * perc_taxa_to_keep)))
 
         taxa_to_keep = set(taxa_to_keep).union(outgroup_ids)
 
@@ -133,6 +153,8 @@ class JackknifeTaxa(object):
 
         # read full multiple sequence alignment
         self.msa = seq_io.read(msa_file)
+        self.signature = replicate_signature([f for f in [msa_file, outgroup_file] if f],
+                                                [perc_taxa_to_keep, model])
 
         # calculate replicates
         #***self.logger.info('Calculating jackknife taxa replicates:')
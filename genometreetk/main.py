@@ -456,7 +456,7 @@ class OptionsParser():
                 while node:
                     support, taxon, aux_info = parse_label(node.label)
                     if taxon:
-                        for t in map(str.strip, taxon.split(';'))[::-1]:
+                        for t in [x.strip() for x in taxon.split(';')][::-1]:
                             taxa.append(t)
                     node = node.parent_node
                     
@@ -19,12 +19,13 @@ import os
 import sys
 import multiprocessing as mp
 import logging
-from collections import defaultdict
 
 import biolib.seq_io as seq_io
 from biolib.external.hmmer import HMMER
+from biolib.parallel import Parallel
 
 from genometreetk.default_values import DefaultValues
+from genometreetk.common import read_tophit_genes
 
 
 class AlignMarkers(object):
@@ -47,6 +48,53 @@ class AlignMarkers(object):
         self.pfam_extension = DefaultValues.PFAM_EXTENSION
         self.tigr_extension = DefaultValues.TIGR_EXTENSION
 
+    def _read_genes_in_genome(self, genome_id):
+        """Get genes within a genome.
+
+        Parameters
+        ----------
+        genome_id : str
+            Unique id of genome.
+
+        Returns
+        -------
+        str
+            Unique id of genome.
+        d[family_id] -> [(gene_id_1, bitscore), ..., (gene_id_N, bitscore)]
+            Genes within genome.
+        """
+
+        marker_id_to_gene_id = read_tophit_genes(self.genome_dirs[genome_id],
+                                                    [self.pfam_extension, self.tigr_extension])
+
+        return (genome_id, marker_id_to_gene_id)
+
+    def _consume_genes_in_genome(self, produced_data, consumer_data):
+        """Collect genes within each genome.
+
+        Parameters
+        ----------
+        produced_data : tuple
+            Genome id and genes within genome.
+        consumer_data : d[genome_id][family_id] -> [(gene_id_1, bitscore), ..., (gene_id_N, bitscore)]
+            Genes within each genome.
+        """
+
+        if consumer_data == None:
+            consumer_data = {}
+
+        # intern genome and family ids as these strings are repeated
+        # across tables; family ids are shared by all genomes
+        genome_id, marker_id_to_gene_id = produced_data
+        consumer_data[sys.intern(genome_id)] = dict((sys.intern(marker_id), hits) for marker_id, hits in marker_id_to_gene_id.items())
+
+        return consumer_data
+
+    def _progress(self, processed_items, total_items):
+        """Report progress of genomes."""
+
+        return '==> Processed %d of %d (%.2f%%) genomes.' % (processed_items, total_items, processed_items * 100.0 / max(total_items, 1))
+
     def _genes_in_genomes(self, genome_ids, genome_dirs):
         """Get genes within genomes.
 
@@ -63,38 +111,18 @@ class AlignMarkers(object):
             Genes within each genome.
         """
 
-        genes_in_genome = {}
-        for genome_id in genome_ids:
-            genome_dir = genome_dirs[genome_id]
-
-            marker_id_to_gene_id = defaultdict(list)
-
-            assembly = genome_dir[genome_dir.rfind('/') + 1:]
-            tophit_file = os.path.join(genome_dir, assembly + self.pfam_extension)
-            with open(tophit_file) as f:
-                f.readline()
-                for line in f:
-                    line_split = line.split('\t')
+        self.genome_dirs = genome_dirs
 
-                    gene_id = line_split[0]
-                    hits = line_split[1].split(';')
-                    for hit in hits:
-                        pfam_id, _evalue, bitscore = hit.split(',')
-                        marker_id_to_gene_id[pfam_id].append((gene_id, float(bitscore)))
+        parallel = Parallel(self.cpus)
+        genes_in_genome = parallel.run(self._read_genes_in_genome, self._consume_genes_in_genome, list(genome_ids), self._progress)
+        if genes_in_genome is None:
+            genes_in_genome = {}
 
-            tophit_file = os.path.join(genome_dir, assembly + self.tigr_extension)
-            with open(tophit_file) as f:
-                f.readline()
-                for line in f:
-                    line_split = line.split('\t')
-
-                    gene_id = line_split[0]
-                    hits = line_split[1].split(';')
-                    for hit in hits:
-                        tigrfam_id, _evalue, bitscore = hit.split(',')
-                        marker_id_to_gene_id[tigrfam_id].append((gene_id, float(bitscore)))
-
-            genes_in_genome[genome_id] = marker_id_to_gene_id
+        # make sure annotations were read for all genomes
+        missing_genomes = set(genome_ids) - set(genes_in_genome)
+        if missing_genomes:
+            self.logger.error('Failed to read annotations for %d genomes: %s' % (len(missing_genomes), ', '.join(sorted(missing_genomes))))
+            sys.exit(-1)
 
         return genes_in_genome
 
@@ -139,16 +167,16 @@ class AlignMarkers(object):
             marker_seq_file = os.path.join(output_msa_dir, marker_id + '.faa')
             fout = open(marker_seq_file, 'w')
             for genome_id in genome_ids:
-                genome_dir = genome_dirs[genome_id]
+                hits = genes_in_genomes[genome_id].get(marker_id, None)
+                if not hits or (ignore_multi_copy and len(hits) > 1):
+                    continue
 
+                # only read genes for genomes containing the marker
+                genome_dir = genome_dirs[genome_id]
                 assembly = genome_dir[genome_dir.rfind('/') + 1:]
                 genes_file = os.path.join(genome_dir, assembly + self.protein_file_ext)
                 seqs = seq_io.read_fasta(genes_file)
 
-                hits = genes_in_genomes[genome_id].get(marker_id, None)
-                if not hits or (ignore_multi_copy and len(hits) > 1):
-                    continue
-
                 # get gene with highest bitscore
                 hits.sort(key=lambda x: x[1], reverse=True)
                 gene_id, _bitscore = hits[0]
@@ -219,7 +247,7 @@ class AlignMarkers(object):
             fout.write(masked_seq + '\n')
         fout.close()
 
-    def run(self, genome_ids, genome_dirs, marker_genes, ignore_multi_copy, output_msa_dir, output_model_dir):
+    def run(self, genome_ids, genome_dirs, marker_genes, ignore_multi_copy, output_msa_dir, output_model_dir, genes_in_genomes=None):
         """Perform multithreaded alignment of marker genes using HMM align.
 
         Parameters
@@ -236,11 +264,14 @@ class AlignMarkers(object):
             Output directory for multiple sequence alignments.
         output_model_dir : str
             Output directory for HMMs.
+        genes_in_genomes : d[genome_id][family_id] -> [(gene_id_1, bitscore), ..., (gene_id_N, bitscore)]
+            Genes within each genome. Determined from top hit files if not specified.
         """
 
         # get mapping of marker ids to gene ids for each genome
-        self.logger.info('Determining genes in genomes of interest.')
-        genes_in_genomes = self._genes_in_genomes(genome_ids, genome_dirs)
+        if genes_in_genomes is None:
+            self.logger.info('Determining genes in genomes of interest.')
+            genes_in_genomes = self._genes_in_genomes(genome_ids, genome_dirs)
 
         # align marker genes
         self.logger.info('Aligning marker genes:')
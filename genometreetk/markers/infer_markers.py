@@ -16,19 +16,22 @@
 ###############################################################################
 
 import os
+import re
 import sys
 import shutil
 import logging
-import ntpath
-from collections import defaultdict
+from itertools import combinations
+from collections import defaultdict, Counter
 
 from genometreetk.default_values import DefaultValues
 from genometreetk.markers.align_markers import AlignMarkers
-from genometreetk.common import read_genome_id_file, read_genome_dir_file
+from genometreetk.common import (read_genome_id_file,
+                                    read_genome_dir_file,
+                                    read_tophit_genes,
+                                    fetch_marker_models)
 
 from biolib.external.fasttree import FastTree
-
-import dendropy
+from biolib.parallel import Parallel
 
 import pickle  # ***
 
@@ -69,42 +72,73 @@ class InferMarkers(object):
         self.pfam_extension = DefaultValues.PFAM_EXTENSION
         self.tigr_extension = DefaultValues.TIGR_EXTENSION
 
-    def _read_gene_hits(self, table, genome_ids, genome_dirs, extension):
-        """Read gene annotations from top hit file.
+    def _read_gene_hits(self, genome_id):
+        """Read Pfam and TIGRFAMs gene annotations from top hit files.
 
         Parameters
         ----------
-        table : defaultdict(lambda: defaultdict(set))
-            Table to populate with gene information.
-        genome_ids : iterable
-            Genomes of interest.
-        genome_dirs : d[assembly_accession] -> directory
-            Path to files for individual genomes.
-        extension : str
-            Extension of file containing top hits to each gene.
+        genome_id : str
+            Unique id of genome.
+
+        Returns
+        -------
+        str
+            Unique id of genome.
+        d[family_id] -> [(gene_id_1, bitscore), ..., (gene_id_N, bitscore)]
+            Genes within genome.
         """
 
-        for genome_id in genome_ids:
-            genome_dir = genome_dirs[genome_id]
+        marker_id_to_gene_id = read_tophit_genes(self.genome_dirs[genome_id],
+                                                    [self.pfam_extension, self.tigr_extension])
 
-            assembly = genome_dir[genome_dir.rfind('/') + 1:]
-            tophit_file = os.path.join(genome_dir, assembly + extension)
+        return (genome_id, marker_id_to_gene_id)
 
-            with open(tophit_file) as f:
-                f.readline()
+    def _consume_gene_hits(self, produced_data, consumer_data):
+        """Merge gene annotations of each genome into gene count and gene location tables.
 
-                for line in f:
-                    line_split = line.split('\t')
+        Parameters
+        ----------
+        produced_data : tuple
+            Genome id and genes within genome.
+        consumer_data : tuple
+            Gene count table and genes within each genome.
+        """
+
+        if consumer_data == None:
+            consumer_data = (defaultdict(lambda: defaultdict(list)), {})
+
+        table, genes_in_genomes = consumer_data
+
+        # intern genome and family ids as these are repeated across
+        # many table entries; this must be done here rather than in the
+        # producer as strings are copied when passed between processes
+        genome_id, marker_id_to_gene_id = produced_data
+        genome_id = sys.intern(genome_id)
+        marker_id_to_gene_id = dict((sys.intern(protein_family), hits) for protein_family, hits in marker_id_to_gene_id.items())
 
-                    gene_id = line_split[0]
-                    hits = line_split[1].split(';')
-                    for hit in hits:
-                        protein_family, _evalue, _bitscore = hit.split(',')
-                        table[protein_family][genome_id].add(gene_id)
+        genes_in_genomes[genome_id] = marker_id_to_gene_id
+        for protein_family, hits in marker_id_to_gene_id.items():
+            # a protein family typically hits only a few genes in a genome
+            # so these are stored as a list rather than a set
+            gene_ids = table[protein_family][genome_id]
+            for gene_id, _bitscore in hits:
+                if gene_id not in gene_ids:
+                    gene_ids.append(gene_id)
 
-    def _gene_count_table(self, genome_ids, genome_dirs):
+        return consumer_data
+
+    def _progress(self, processed_items, total_items):
+        """Report progress of genomes."""
+
+        return '==> Processed %d of %d (%.2f%%) genomes.' % (processed_items, total_items, processed_items * 100.0 / max(total_items, 1))
+
+    def _read_annotations(self, genome_ids, genome_dirs):
         """Get Pfam and TIGRFAMs annotations for genomes.
 
+        The top hit files of each genome are parsed once to produce
+        both the gene count table used to identify marker genes and the
+        genes within each genome required to align these markers.
+
         Parameters
         ----------
         genome_ids : iterable
@@ -114,15 +148,28 @@ class InferMarkers(object):
 
         Returns
         -------
-        d[assembly_accession][genome_id] -> set([gene_id_1, ..., gene_id_N])
+        d[family_id][genome_id] -> [gene_id_1, ..., gene_id_N]
             Gene location of protein families within each genome.
+        d[genome_id][family_id] -> [(gene_id_1, bitscore), ..., (gene_id_N, bitscore)]
+            Genes within each genome.
         """
 
-        table = defaultdict(lambda: defaultdict(set))
-        self._read_gene_hits(table, genome_ids, genome_dirs, self.pfam_extension)
-        self._read_gene_hits(table, genome_ids, genome_dirs, self.tigr_extension)
+        self.genome_dirs = genome_dirs
 
-        return table
+        parallel = Parallel(self.cpus)
+        annotations = parallel.run(self._read_gene_hits, self._consume_gene_hits, list(genome_ids), self._progress)
+        if annotations is None:
+            annotations = (defaultdict(lambda: defaultdict(list)), {})
+
+        table, genes_in_genomes = annotations
+
+        # make sure annotations were read for all genomes
+        missing_genomes = set(genome_ids) - set(genes_in_genomes)
+        if missing_genomes:
+            self.logger.error('Failed to read annotations for %d genomes: %s' % (len(missing_genomes), ', '.join(sorted(missing_genomes))))
+            sys.exit(-1)
+
+        return table, genes_in_genomes
 
     def _marker_genes(self, genome_ids, gene_count_table, ubiquity_threshold, single_copy_threshold, output_file):
         """Identify genes meeting ubiquity and single-copy thresholds.
@@ -131,7 +178,7 @@ class InferMarkers(object):
         ----------
         genome_ids : iterable
             Genomes of interest.
-        gene_count_table : d[family_id][genome_id] -> set([gene_id_1, ..., gene_id_N])
+        gene_count_table : d[family_id][genome_id] -> [gene_id_1, ..., gene_id_N]
             Gene location of protein families within each genome.
         ubiquity_threshold : float
             Threshold for defining a ubiquitous marker genes [0, 1].
@@ -150,35 +197,61 @@ class InferMarkers(object):
             self.logger.error('Ubiquity or single-copy threshold is invalid: %f, %f' % (ubiquity_threshold, single_copy_threshold))
             sys.exit(0)
 
-        fout = open(output_file, 'w')
-        fout.write('Model accession\tUbiquity\tSingle copy\n')
+        rows = ['Model accession\tUbiquity\tSingle copy\n']
 
         # find genes meeting ubiquity and single-copy thresholds
+        #
+        # Only genomes with hits to a protein family need to be considered
+        # as all other genomes have a gene count of zero.
+        genome_ids = set(genome_ids)
         markers = {}
         for protein_family, genes_in_genomes in gene_count_table.items():
-            ubiquity = 0
-            single_copy = 0
+            hit_counts = [len(gene_ids) for genome_id, gene_ids in genes_in_genomes.items()
+                            if genome_id in genome_ids and gene_ids]
 
-            for genome_id in genome_ids:
-                count = len(genes_in_genomes.get(genome_id, []))
-
-                if count > 0:
-                    ubiquity += 1
-
-                if count == 1:
-                    single_copy += 1
+            ubiquity = len(hit_counts)
+            single_copy = sum(1 for count in hit_counts if count == 1)
 
             u = ubiquity * 100.0 / len(genome_ids)
             s = single_copy * 100.0 / ubiquity
-            fout.write('%s\t%.1f\t%.1f\n' % (protein_family, u, s))
+            rows.append('%s\t%.1f\t%.1f\n' % (protein_family, u, s))
 
             if ubiquity >= (ubiquity_threshold * len(genome_ids)) and single_copy >= (single_copy_threshold * ubiquity):
                 markers[protein_family] = (u, s)
 
+        fout = open(output_file, 'w')
+        fout.write(''.join(rows))
         fout.close()
 
         return markers
 
+    def _model_number(self, marker_gene):
+        """Determine number of a Pfam or TIGRFAMs model.
+
+        Parameters
+        ----------
+        marker_gene : str
+            Pfam (PFnnnnn.v) or TIGRFAMs (TIGRnnnnn) accession.
+
+        Returns
+        -------
+        int
+            Number of model.
+        """
+
+        if marker_gene.startswith('PF'):
+            model_num = marker_gene[2:].split('.')[0]
+        elif marker_gene.startswith('TIGR'):
+            model_num = marker_gene[4:]
+        else:
+            model_num = ''
+
+        if not model_num.isdigit():
+            self.logger.error('Marker gene is not a Pfam or TIGRFAMs accession: %s' % marker_gene)
+            sys.exit(-1)
+
+        return int(model_num)
+
     def _identify_redundant_hmms(self, marker_genes, gene_count_table, redundancy, output_file):
         """Identify HMMs that consistently hit the same gene.
 
@@ -194,7 +267,7 @@ class InferMarkers(object):
         ----------
         marker_genes : iterable
             Marker genes to process for redundancy.
-        gene_count_table : d[family_id][genome_id] -> set([gene_id_1, ..., gene_id_N])
+        gene_count_table : d[family_id][genome_id] -> [gene_id_1, ..., gene_id_N]
             Gene location of protein families within each genome.
         redundancy : float
             Threshold for declaring HMMs redundant.
@@ -211,25 +284,26 @@ class InferMarkers(object):
             self.logger.error('Redundancy threshold is invalid: %f.' % redundancy)
             sys.exit(0)
 
-        fout = open(output_file, 'w')
-        fout.write('Kept marker\tRedundant marker\n')
-
+        # HMMs are referred to by their index in this list so pairs
+        # can be counted, ordered, and compared using integers
         marker_gene_list = list(marker_genes)
 
-        # count number of times HMMs hit the same gene
-        redundancy_count = defaultdict(lambda: defaultdict(int))
-        for i in range(0, len(marker_gene_list)):
-            marker_gene_i = marker_gene_list[i]
-            genes_in_genomes_i = gene_count_table[marker_gene_i]
+        # build inverted index indicating the HMMs hitting each gene so
+        # only HMMs actually hitting a common gene need to be considered
+        gene_markers = defaultdict(lambda: defaultdict(list))
+        for marker_index, marker_gene in enumerate(marker_gene_list):
+            for genome_id, gene_ids in gene_count_table[marker_gene].items():
+                for gene_id in gene_ids:
+                    gene_markers[genome_id][gene_id].append(marker_index)
 
-            for j in range(i + 1, len(marker_genes)):
-                marker_gene_j = marker_gene_list[j]
-                genes_in_genomes_j = gene_count_table[marker_gene_j]
+        # count number of genomes where HMMs hit the same gene
+        redundancy_count = Counter()
+        for genes in gene_markers.values():
+            redundant_pairs = set()
+            for markers in genes.values():
+                redundant_pairs.update(combinations(markers, 2))
 
-                for genome_id in genes_in_genomes_i:
-                    if genome_id in genes_in_genomes_j:
-                        if genes_in_genomes_i[genome_id].intersection(genes_in_genomes_j[genome_id]):
-                            redundancy_count[marker_gene_i][marker_gene_j] += 1
+            redundancy_count.update(redundant_pairs)
 
         # Identify HMMs consistently hitting the same gene across genomes.
         #
@@ -243,48 +317,51 @@ class InferMarkers(object):
         # will NOT always result in the largest possible set of HMMs (i.e., Y, Z may
         # be removed when one could just remove X), but this seems fair since it is unclear
         # how to resolve such situations.
+        #
+        # Pairs are resolved in the order of the marker genes.
+
+        # determine type of each model once instead of for every pair; model
+        # numbers are only needed to resolve pairs of the same type so are
+        # determined lazily and cached
+        is_pfam = [marker_gene.startswith('PF') for marker_gene in marker_gene_list]
+        model_nums = {}
+
+        removed = set()
+        removals = []
+        for i, j in sorted(pair for pair, count in redundancy_count.items() if count > redundancy):
+            if i in removed or j in removed:
+                # marker gene from this redundant pair is already marked for removal
+                continue
+
+            # preferentially discard PFAM models
+            if is_pfam[i] and not is_pfam[j]:
+                kept, redundant = j, i
+            elif not is_pfam[i] and is_pfam[j]:
+                kept, redundant = i, j
+            else:
+                # take Pfam or TIGRFAMs model with lowest number as
+                # these tend to encode better known protein families
+                # and, for TIGRFAMs, to be more universal
+                for k in (i, j):
+                    if k not in model_nums:
+                        model_nums[k] = self._model_number(marker_gene_list[k])
+
+                if model_nums[i] > model_nums[j]:
+                    kept, redundant = j, i
+                else:
+                    kept, redundant = i, j
+
+            removed.add(redundant)
+            removals.append((kept, redundant))
+
         hmms_to_remove = set()
-        for marker_gene_i in redundancy_count:
-            for marker_gene_j, count in redundancy_count[marker_gene_i].items():
-                if count > redundancy:
-                    if marker_gene_i in hmms_to_remove or marker_gene_j in hmms_to_remove:
-                        # marker gene from this redundant pair is already marked for removal
-                        continue
-
-                    # preferentially discard PFAM models
-                    if 'PF' in marker_gene_i and not 'PF' in marker_gene_j:
-                        hmms_to_remove.add(marker_gene_i)
-                        fout.write('%s\t%s\n' % (marker_gene_j, marker_gene_i))
-                    elif not 'PF' in marker_gene_i and 'PF' in marker_gene_j:
-                        hmms_to_remove.add(marker_gene_j)
-                        fout.write('%s\t%s\n' % (marker_gene_i, marker_gene_j))
-                    elif 'PF' in marker_gene_i and 'PF' in marker_gene_j:
-                        # take Pfam model with lowest number as these tend
-                        # to encode better known protein families
-                        pfam_num_i = marker_gene_i.replace('PF', '')
-                        pfam_num_i = int(pfam_num_i[0:pfam_num_i.find('.')])
-                        pfam_num_j = marker_gene_j.replace('PF', '')
-                        pfam_num_j = int(pfam_num_j[0:pfam_num_j.find('.')])
-
-                        if pfam_num_i > pfam_num_j:
-                            hmms_to_remove.add(marker_gene_i)
-                            fout.write('%s\t%s\n' % (marker_gene_j, marker_gene_i))
-                        else:
-                            hmms_to_remove.add(marker_gene_j)
-                            fout.write('%s\t%s\n' % (marker_gene_i, marker_gene_j))
-                    else:
-                        # take TIGRFAMs model with lowest number as these
-                        # tend to be more universal and/or to encode better
-                        # known protein families
-                        tigr_num_i = int(marker_gene_i.replace('TIGR', ''))
-                        tigr_num_j = int(marker_gene_j.replace('TIGR', ''))
-                        if tigr_num_i > tigr_num_j:
-                            hmms_to_remove.add(marker_gene_i)
-                            fout.write('%s\t%s\n' % (marker_gene_j, marker_gene_i))
-                        else:
-                            hmms_to_remove.add(marker_gene_j)
-                            fout.write('%s\t%s\n' % (marker_gene_i, marker_gene_j))
+        rows = ['Kept marker\tRedundant marker\n']
+        for kept, redundant in removals:
+            hmms_to_remove.add(marker_gene_list[redundant])
+            rows.append('%s\t%s\n' % (marker_gene_list[kept], marker_gene_list[redundant]))
 
+        fout = open(output_file, 'w')
+        fout.write(''.join(rows))
         fout.close()
 
         return hmms_to_remove
@@ -300,20 +377,7 @@ class InferMarkers(object):
             Directory to store HMM models.
         """
 
-        marker_id_to_name = {}
-        for line in open(self.pfam_model_file):
-            if 'NAME' in line:
-                name = line.split()[1].rstrip()
-            elif 'ACC' in line:
-                acc = line.split()[1].rstrip()
-                marker_id_to_name[acc] = name
-
-        for marker_id in marker_genes:
-            if 'PF' in marker_id:
-                os.system('hmmfetch ' + self.pfam_model_file + ' ' + marker_id_to_name[marker_id] + ' > ' + os.path.join(output_model_dir, marker_id + '.hmm'))
-            else:
-                model_file = os.path.join(self.tigrfams_model_dir, marker_id + '.HMM')
-                os.system('hmmfetch ' + model_file + ' ' + marker_id + ' > ' + os.path.join(output_model_dir, marker_id + '.hmm'))
+        fetch_marker_models(marker_genes, self.pfam_model_file, self.tigrfams_model_dir, output_model_dir, self.cpus)
 
     def identify_marker_genes(self, ingroup_file,
                             ubiquity_threshold, single_copy_threshold, redundancy,
@@ -352,7 +416,7 @@ class InferMarkers(object):
         # identify marker genes
         self.logger.info('Identifying marker genes.')
         gene_stats_file = os.path.join(output_model_dir, '..', 'gene_stats.all.tsv')
-        gene_count_table = self._gene_count_table(genome_ids, genome_dirs)
+        gene_count_table, genes_in_genomes = self._read_annotations(genome_ids, genome_dirs)
         marker_gene_stats = self._marker_genes(genome_ids, gene_count_table, ubiquity_threshold, single_copy_threshold, gene_stats_file)
 
         # with open('tmp_marker_gene_list', 'wb') as f:
@@ -380,10 +444,88 @@ class InferMarkers(object):
 
         # align gene sequences
         align_markers = AlignMarkers(self.cpus)
-        align_markers.run(genome_ids, genome_dirs, marker_genes, False, output_msa_dir, output_model_dir)
+        align_markers.run(genome_ids, genome_dirs, marker_genes, False, output_msa_dir, output_model_dir, genes_in_genomes)
 
         return len(genome_ids), len(ncbi_genome_ids), len(user_genome_ids), genome_ids, marker_gene_stats, marker_genes
 
+    def _remove_trailing_stars(self, msa_file):
+        """Replace trailing stars in multiple sequence alignment with gaps.
+
+        Parameters
+        ----------
+        msa_file : str
+            File containing multiple sequence alignment.
+        """
+
+        # stream alignment into a temporary file so the
+        # alignment never needs to be held in memory
+        tmp_file = msa_file + '.tmp'
+        with open(msa_file) as fin, open(tmp_file, 'w') as fout:
+            for line in fin:
+                if line[0] != '>':
+                    # replace trailing star with a gap so all
+                    # rows of the alignment retain the same length
+                    seq = line.rstrip('\r\n')
+                    if seq.endswith('*'):
+                        line = seq[0:-1] + '-' + line[len(seq):]
+                fout.write(line)
+
+        os.replace(tmp_file, msa_file)
+
+        return msa_file
+
+    def _genome_id_tree(self, tree_info):
+        """Create gene tree without gene ids.
+
+        Parameters
+        ----------
+        tree_info : tuple
+            Filename of multiple sequence alignment and prefix of gene tree.
+        """
+
+        tree_filename, tree_prefix = tree_info
+
+        if tree_prefix.startswith('PF'):
+            # patch up output file for Pfam trees
+            old_tree_prefix = tree_prefix
+            tree_prefix = '.'.join(tree_filename.split('.')[0:2])
+            shutil.move(os.path.join(self.gene_tree_dir, old_tree_prefix + '.tree'),
+                            os.path.join(self.gene_tree_dir, tree_prefix + '.tree'))
+
+        gene_tree_file = os.path.join(self.gene_tree_dir, tree_prefix + '.tree')
+        with open(gene_tree_file) as f:
+            gene_tree = f.read()
+
+        # rename leaf nodes to contain only genome id by directly rewriting
+        # the Newick string as leaf labels are of the form <genome_id>|<gene_id>
+        gene_tree = re.sub(r'([(,]\s*)([^(),:;\s]+?)' + re.escape(DefaultValues.SEQ_CONCAT_CHAR) + r'[^(),:;\s]*',
+                            r'\1\2',
+                            gene_tree)
+
+        output_tree_file = os.path.join(self.gene_tree_dir, tree_prefix + '.genome_ids.tree')
+        with open(output_tree_file, 'w') as fout:
+            fout.write(gene_tree)
+
+        return tree_info
+
+    def _consume_processed(self, produced_data, consumer_data):
+        """Collect items successfully processed by a producer.
+
+        Parameters
+        ----------
+        produced_data : object
+            Item processed by producer.
+        consumer_data : list
+            Items processed so far.
+        """
+
+        if consumer_data == None:
+            consumer_data = []
+
+        consumer_data.append(produced_data)
+
+        return consumer_data
+
     def infer_gene_trees(self, msa_dir, output_dir, extension):
         """Infer gene trees.
 
@@ -399,46 +541,33 @@ class InferMarkers(object):
 
         files = os.listdir(msa_dir)
         msa_files = []
+        tree_prefixes = []
         for f in files:
             if f.endswith(extension):
                 msa_file = os.path.join(msa_dir, f)
                 msa_files.append(msa_file)
+                tree_prefixes.append((f, f.partition('.')[0]))
 
-                fin = open(msa_file)
-                data = fin.readlines()
-                fin.close()
+        parallel = Parallel(self.cpus)
+        processed_msa_files = parallel.run(self._remove_trailing_stars, self._consume_processed, msa_files, None)
+        if processed_msa_files is None:
+            processed_msa_files = []
 
-                fout = open(msa_file, 'w')
-                for line in data:
-                    if line[0] != '>':
-                        # remove trailing star
-                        if line[-1] == '*':
-                            line = line[0:-1]
-                    fout.write(line)
-                fout.close()
+        if len(processed_msa_files) != len(msa_files):
+            missing_msa_files = set(msa_files) - set(processed_msa_files)
+            self.logger.error('Failed to process %d multiple sequence alignments: %s' % (len(missing_msa_files), ', '.join(sorted(missing_msa_files))))
+            sys.exit(-1)
 
         fasttree = FastTree(multithreaded=False)
         fasttree.parallel_run(msa_files, 'prot', 'wag', output_dir, self.cpus)
 
         # create gene tree without gene ids for visualization in ARB
-        for msa_file in msa_files:
-            tree_filename = ntpath.basename(msa_file)
-            tree_prefix = tree_filename[0:tree_filename.find('.')]
-
-            if tree_prefix.startswith('PF'):
-                # patch up output file for Pfam trees
-                old_tree_prefix = tree_prefix
-                tree_prefix = '.'.join(tree_filename.split('.')[0:2])
-                shutil.move(os.path.join(output_dir, old_tree_prefix + '.tree'),
-                                os.path.join(output_dir, tree_prefix + '.tree'))
-
-            gene_tree_file = os.path.join(output_dir, tree_prefix + '.tree')
-            gene_tree = dendropy.Tree.get_from_path(gene_tree_file, schema='newick', rooting='force-unrooted', preserve_underscores=True)
-
-            # rename nodes to contain only genome id
-            for node in gene_tree.leaf_nodes():
-                genome_id = node.taxon.label.split(DefaultValues.SEQ_CONCAT_CHAR)[0]
-                node.taxon.label = genome_id
-
-            output_tree_file = os.path.join(output_dir, tree_prefix + '.genome_ids.tree')
-            gene_tree.write_to_path(output_tree_file, schema='newick', suppress_rooting=True, unquoted_underscores=True)
+        self.gene_tree_dir = output_dir
+        processed_trees = parallel.run(self._genome_id_tree, self._consume_processed, tree_prefixes, None)
+        if processed_trees is None:
+            processed_trees = []
+
+        if len(processed_trees) != len(tree_prefixes):
+            missing_trees = set(tree_prefixes) - set(processed_trees)
+            self.logger.error('Failed to create gene trees without gene ids for %d alignments: %s' % (len(missing_trees), ', '.join(sorted(f for f, _ in missing_trees))))
+            sys.exit(-1)
@@ -21,9 +21,10 @@ import logging
 
 from biolib.external.fasttree import FastTree
 from biolib.common import make_sure_path_exists
+from biolib.parallel import Parallel
 
 from genometreetk.default_values import DefaultValues
-from genometreetk.common import create_concatenated_alignment
+from genometreetk.common import create_concatenated_alignment, subtree_leaf_ranges
 from genometreetk.jackknife_markers import JackknifeMarkers
 
 import dendropy
@@ -53,6 +54,108 @@ class LgtTest(object):
 
         self.cpus = cpus
 
+    def _producer(self, marker_gene):
+        """Compare gene tree to well-supported splits of the genome tree.
+
+        Parameters
+        ----------
+        marker_gene : str
+            Unique id of marker gene.
+        """
+
+        # read gene tree
+        f = marker_gene + '.tree'
+        gene_tree_file = os.path.join(self.gene_tree_dir, f)
+        gene_tree = dendropy.Tree.get_from_path(gene_tree_file, schema='newick', rooting='force-unrooted', preserve_underscores=True)
+
+        # prune gene tree so each genome is present exactly once and
+        # rename retained nodes to contain only genome id
+        processed_genome_ids = set()
+        gene_tree_taxa_set = set()
+        taxa_to_prune = []
+        for node in gene_tree.leaf_node_iter():
+            genome_id = node.taxon.label.partition(DefaultValues.SEQ_CONCAT_CHAR)[0]
+
+            if genome_id in processed_genome_ids or genome_id not in self.genome_ids:
+                taxa_to_prune.append(node.taxon)
+            else:
+                node.taxon.label = genome_id
+                gene_tree_taxa_set.add(genome_id)
+
+            processed_genome_ids.add(genome_id)
+
+        gene_tree.prune_taxa(taxa_to_prune)
+
+        # re-encode the split system over the new taxon namespace
+        gene_tree.migrate_taxon_namespace(dendropy.TaxonNamespace(gene_tree_taxa_set))
+        gene_tree.encode_bipartitions()
+        split_bitmasks = set(b.split_bitmask for b in gene_tree.bipartition_encoding)
+
+        # determine number of splits recovered by or compatible with this gene tree
+        recovered_splits = 0
+        compatible_splits = 0
+        compatible_edge_length = 0
+        for split, edge_length in self.splits:
+            common_taxa_labels = split.intersection(gene_tree_taxa_set)
+
+            common_split = gene_tree.taxon_namespace.taxa_bitmask(labels=common_taxa_labels)
+            normalized_split = dendropy.Bipartition.normalize_bitmask(
+                                bitmask=common_split,
+                                fill_bitmask=gene_tree.taxon_namespace.all_taxa_bitmask(),
+                                lowest_relevant_bit=1)
+
+            if normalized_split in split_bitmasks:
+                recovered_splits += 1
+
+            if gene_tree.is_compatible_with_bipartition(dendropy.Bipartition(bitmask=normalized_split, is_rooted=False)):
+                compatible_splits += 1
+                compatible_edge_length += edge_length
+
+        perc_recovered_splits = recovered_splits * 100.0 / len(self.splits)
+        perc_comp_splits = compatible_splits * 100.0 / len(self.splits)
+        norm_comp_edge_length = float(compatible_edge_length) / self.splits_edge_length
+
+        # calculate weighted Robinson-Foulds (Manhattan) and Felsenstein's Euclidean
+        # distances to the concatenated genome tree
+        pruned_tree = self.tree.clone(depth=2)
+        pruned_tree.retain_taxa_with_labels(gene_tree.taxon_namespace.labels())
+        pruned_tree.migrate_taxon_namespace(gene_tree.taxon_namespace)
+        pruned_tree.encode_bipartitions()
+
+        pruned_tree_edge_len = sum([e.length for e in pruned_tree.edges() if e.length])
+        gene_tree_edge_len = sum([e.length for e in gene_tree.edges() if e.length])
+        pruned_tree.scale_edges(1.0 / pruned_tree_edge_len)
+        gene_tree.scale_edges(1.0 / gene_tree_edge_len)
+
+        manhattan = dendropy.calculate.treecompare.weighted_robinson_foulds_distance(pruned_tree, gene_tree)
+        euclidean = dendropy.calculate.treecompare.euclidean_distance(pruned_tree, gene_tree)
+
+        return (marker_gene, (perc_recovered_splits, perc_comp_splits, norm_comp_edge_length, manhattan, euclidean))
+
+    def _consumer(self, produced_data, consumer_data):
+        """Consume results from each gene tree.
+
+        Parameters
+        ----------
+        produced_data : tuple
+            Marker gene and distances between gene tree and genome tree.
+        consumer_data : dict
+            Distances determined for each marker gene.
+        """
+
+        if consumer_data == None:
+            consumer_data = {}
+
+        marker_gene, distances = produced_data
+        consumer_data[marker_gene] = distances
+
+        return consumer_data
+
+    def _progress(self, processed_items, total_items):
+        """Report progress of gene trees."""
+
+        return '==> Processed %d of %d (%.2f%%) gene trees.' % (processed_items, total_items, processed_items * 100.0 / max(total_items, 1))
+
     def run(self, genome_ids,
                     marker_genes,
                     hmm_model_file,
@@ -112,7 +215,8 @@ class LgtTest(object):
         # identify well-support, internal splits
         self.logger.info('Identifying well-support, internal splits.')
         tree = dendropy.Tree.get_from_path(jackknife_tree, schema='newick', rooting='force-unrooted', preserve_underscores=True)
-        num_leaves = len(tree.leaf_nodes())
+        leaf_labels, leaf_ranges = subtree_leaf_ranges(tree)
+        num_leaves = len(leaf_labels)
 
         num_internal_nodes = 0
         num_major_splits = 0
@@ -122,13 +226,14 @@ class LgtTest(object):
         for node in tree.internal_nodes():
             num_internal_nodes += 1
 
-            num_node_leaves = len(node.leaf_nodes())
+            start, end = leaf_ranges[node]
+            num_node_leaves = end - start
             if min(num_node_leaves, num_leaves - num_node_leaves) >= max(min_per_taxa * num_leaves, 2):
                 num_major_splits += 1
 
                 if int(node.label) > (min_support * 100.0):
                     well_supported_major_splits += 1
-                    split = set([x.taxon.label for x in node.leaf_nodes()])
+                    split = set(leaf_labels[start:end])
                     splits.append((split, node.edge_length))
 
         self.logger.info('# internal nodes: %d' % num_internal_nodes)
@@ -138,80 +243,21 @@ class LgtTest(object):
         # filter gene trees that do not recover well-support, internal splits
         self.logger.info('Filtering gene trees.')
 
-        distances = {}
-        for i, mg in enumerate(sorted(marker_genes)):
-            sys.stdout.write('==> Processed %d of %d (%.2f) gene trees.\r' % (i + 1, len(marker_genes), (i + 1) * 100.0 / len(marker_genes)))
-            sys.stdout.flush()
-
-            # read gene tree
-            f = mg + '.tree'
-            gene_tree_file = os.path.join(gene_tree_dir, f)
-            gene_tree = dendropy.Tree.get_from_path(gene_tree_file, schema='newick', rooting='force-unrooted', preserve_underscores=True)
-
-            # prune gene tree so each genome is present exactly once
-            processed_genome_ids = set()
-            taxa_to_prune = []
-            for node in gene_tree.leaf_nodes():
-                genome_id = node.taxon.label.split(DefaultValues.SEQ_CONCAT_CHAR)[0]
-
-                if genome_id in processed_genome_ids or genome_id not in genome_ids:
-                    taxa_to_prune.append(node.taxon)
-
-                processed_genome_ids.add(genome_id)
-
-            gene_tree.prune_taxa(taxa_to_prune)
-
-            # rename nodes to contain only genome id
-            gene_tree_taxa_set = set()
-            for node in gene_tree.leaf_nodes():
-                genome_id = node.taxon.label.split(DefaultValues.SEQ_CONCAT_CHAR)[0]
-                node.taxon.label = genome_id
-                gene_tree_taxa_set.add(genome_id)
-
-            # re-encode the split system over the new taxon namespace
-            gene_tree.migrate_taxon_namespace(dendropy.TaxonNamespace(gene_tree_taxa_set))
-            gene_tree.encode_bipartitions()
-            split_bitmasks = set(b.split_bitmask for b in gene_tree.bipartition_encoding)
-
-            # determine number of splits recovered by or compatible with this gene tree
-            recovered_splits = 0
-            compatible_splits = 0
-            compatible_edge_length = 0
-            for split, edge_length in splits:
-                common_taxa_labels = split.intersection(gene_tree_taxa_set)
-
-                common_split = gene_tree.taxon_namespace.taxa_bitmask(labels=common_taxa_labels)
-                normalized_split = dendropy.Bipartition.normalize_bitmask(
-                                    bitmask=common_split,
-                                    fill_bitmask=gene_tree.taxon_namespace.all_taxa_bitmask(),
-                                    lowest_relevant_bit=1)
-
-                if normalized_split in split_bitmasks:
-                    recovered_splits += 1
-
-                if gene_tree.is_compatible_with_bipartition(dendropy.Bipartition(bitmask=normalized_split, is_rooted=False)):
-                    compatible_splits += 1
-                    compatible_edge_length += edge_length
-
-            perc_recovered_splits = recovered_splits * 100.0 / len(splits)
-            perc_comp_splits = compatible_splits * 100.0 / len(splits)
-            norm_comp_edge_length = float(compatible_edge_length) / sum([s[1] for s in splits])
-
-            # calculate weighted Robinson-Foulds (Manhattan) and Felsenstein's Euclidean
-            # distances to the concatenated genome tree
-            pruned_tree = tree.clone(depth=2)
-            pruned_tree.retain_taxa_with_labels(gene_tree.taxon_namespace.labels())
-            pruned_tree.migrate_taxon_namespace(gene_tree.taxon_namespace)
-            pruned_tree.encode_bipartitions()
-
-            pruned_tree_edge_len = sum([e.length for e in pruned_tree.edges() if e.length])
-            gene_tree_edge_len = sum([e.length for e in gene_tree.edges() if e.length])
-            pruned_tree.scale_edges(1.0 / pruned_tree_edge_len)
-            gene_tree.scale_edges(1.0 / gene_tree_edge_len)
-
-            manhattan = dendropy.calculate.treecompare.weighted_robinson_foulds_distance(pruned_tree, gene_tree)
-            euclidean = dendropy.calculate.treecompare.euclidean_distance(pruned_tree, gene_tree)
-
-            distances[mg] = (perc_recovered_splits, perc_comp_splits, norm_comp_edge_length, manhattan, euclidean)
+        self.tree = tree
+        self.splits = splits
+        self.splits_edge_length = sum([s[1] for s in splits])
+        self.genome_ids = genome_ids
+        self.gene_tree_dir = gene_tree_dir
+
+        parallel = Parallel(self.cpus)
+        distances = parallel.run(self._producer, self._consumer, sorted(marker_genes), self._progress)
+        if distances is None:
+            distances = {}
+
+        # make sure all gene trees were processed successfully
+        missing_markers = set(marker_genes) - set(distances)
+        if missing_markers:
+            self.logger.error('Failed to process gene trees for %d marker genes: %s' % (len(missing_markers), ', '.join(sorted(missing_markers))))
+            sys.exit(-1)
 
         return distances, num_internal_nodes, num_major_splits, well_supported_major_splits
@@ -58,6 +58,8 @@ class PhylogeneticDiversity():
     def _taxon_pd(self, tree, ingroup, outgroup):
         """Calculate phylogenetic gain of each ingroup taxon relative to outgroup."""
 
+        _has_ingroup, has_outgroup = self._subtree_membership(tree, ingroup, outgroup)
+
         pg_taxon = {}
         for leaf in tree.leaf_node_iter():
             if leaf.taxon.label in ingroup:
@@ -66,16 +68,14 @@ class PhylogeneticDiversity():
                 parent = leaf
                 outgroup_taxon = 'None'
                 while parent:
-                    # check for outgroup taxon
-                    stop = False
-                    for tip in parent.leaf_iter():
-                        if tip.taxon.label in outgroup:
-                            outgroup_taxon = tip.taxon.label
-                            if outgroup_taxon in ingroup:
-                                outgroup_taxon += ' (one or more outgroup taxa are assigned to this ingroup taxon)'
-                            stop = True
-                            
-                    if stop:
+                    # check for outgroup taxon, only scanning the
+                    # leaves of the node where the search terminates
+                    if has_outgroup[parent]:
+                        for tip in parent.leaf_iter():
+                            if tip.taxon.label in outgroup:
+                                outgroup_taxon = tip.taxon.label
+                                if outgroup_taxon in ingroup:
+                                    outgroup_taxon += ' (one or more outgroup taxa are assigned to this ingroup taxon)'
                         break
                     
                     pg += parent.edge.length
@@ -155,9 +155,39 @@ class PhylogeneticDiversity():
                    
         return total_pd, len(in_taxa), in_pd, len(out_taxa), out_pd
         
+    def _subtree_membership(self, tree, ingroup, outgroup):
+        """Determine if each subtree contains ingroup and/or outgroup taxa.
+
+        Membership is propagated from the leaves in a single postorder
+        traversal so leaves do not need to be revisited for every node.
+
+        Returns
+        -------
+        dict : d[node] -> boolean
+            Indicates if subtree contains an ingroup taxon.
+        dict : d[node] -> boolean
+            Indicates if subtree contains an outgroup taxon.
+        """
+
+        has_ingroup = {}
+        has_outgroup = {}
+        for node in tree.postorder_node_iter():
+            if node.is_leaf():
+                genome_id = node.taxon.label
+                has_ingroup[node] = genome_id in ingroup
+                has_outgroup[node] = genome_id in outgroup
+            else:
+                children = node.child_nodes()
+                has_ingroup[node] = any(has_ingroup[c] for c in children)
+                has_outgroup[node] = any(has_outgroup[c] for c in children)
+
+        return has_ingroup, has_outgroup
+
     def _clade_pd(self, tree, ingroup, outgroup):
         """Calculate PD for named clades."""
         
+        has_ingroup, has_outgroup = self._subtree_membership(tree, ingroup, outgroup)
+
         pd = {}
         for node in tree.preorder_node_iter():
             if not node.label:
@@ -183,20 +213,10 @@ class PhylogeneticDiversity():
                         
                     # check if group contains taxa from
                     # the ingroup and/or outgroup
-                    ingroup_leaves = False
-                    outgroup_leaves = False
-                    for leaf in nn.leaf_iter():
-                        genome_id = leaf.taxon.label
-                        if genome_id in ingroup:
-                            ingroup_leaves = True
-                        
-                        if genome_id in outgroup:
-                            outgroup_leaves = True
-                            
-                    if ingroup_leaves:
+                    if has_ingroup[nn]:
                         in_taxon_pd += nn.edge.length
 
-                    if outgroup_leaves:
+                    if has_outgroup[nn]:
                         out_taxon_pd += nn.edge.length
                         
                     if nn.is_leaf():
@@ -246,13 +266,13 @@ class PhylogeneticDiversity():
         self.logger.info(' ... identified %d named clades.' % len(pd_clade))
 
         # report results
-        fout = open(output_file, 'w')
-        fout.write('Clade')
-        fout.write('\tTaxa\tPD\tPercent PD')
-        fout.write('\tOut Taxa\tOut PD\tOut Percent PD')
-        fout.write('\tIn Taxa\tIn PD\tIn Percent PD')
-        fout.write('\tIn PG\tIn Percent PG\n')
-        
+        rows = ['Clade'
+                '\tTaxa\tPD\tPercent PD'
+                '\tOut Taxa\tOut PD\tOut Percent PD'
+                '\tIn Taxa\tIn PD\tIn Percent PD'
+                '\tIn PG\tIn Percent PG']
+
+        row_format = '%s' + '\t%d\t%.2f\t%.2f' * 3 + '\t%.2f\t%.2f'
         ordered_taxa = Taxonomy().sort_taxa(pd_clade.keys())
         for taxon in ordered_taxa:
             taxon_pd, in_taxon_pd, in_taxon_count, out_taxon_pd, out_taxon_count = pd_clade[taxon]
@@ -261,10 +281,12 @@ class PhylogeneticDiversity():
             
             taxon_pd = max(taxon_pd, 1e-9) # make sure PD is never exactly zero to avoid division errors
             
-            row = taxon
-            row += '\t%d\t%.2f\t%.2f' % (taxon_count, taxon_pd, taxon_pd * 100 / total_pd)
-            row += '\t%d\t%.2f\t%.2f' % (out_taxon_count, out_taxon_pd, out_taxon_pd * 100 / taxon_pd)
-            row += '\t%d\t%.2f\t%.2f' % (in_taxon_count, in_taxon_pd, in_taxon_pd * 100 / taxon_pd)
-            row += '\t%.2f\t%.2f' % (in_taxon_pg, in_taxon_pg * 100 / taxon_pd)
-            fout.write(row + '\n')
+            rows.append(row_format % (taxon,
+                                        taxon_count, taxon_pd, taxon_pd * 100 / total_pd,
+                                        out_taxon_count, out_taxon_pd, out_taxon_pd * 100 / taxon_pd,
+                                        in_taxon_count, in_taxon_pd, in_taxon_pd * 100 / taxon_pd,
+                                        in_taxon_pg, in_taxon_pg * 100 / taxon_pd))
+
+        fout = open(output_file, 'w')
+        fout.write('\n'.join(rows) + '\n')
         fout.close()
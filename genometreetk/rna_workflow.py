@@ -24,8 +24,7 @@ from biolib.common import remove_extension
 from biolib.external.blast import Blast
 from biolib.taxonomy import Taxonomy
 
-from genometreetk.common import (read_gtdb_metadata,
-                                 read_gtdb_taxonomy)
+from genometreetk.common import read_gtdb_metadata
 
 
 class RNA_Workflow(object):
@@ -280,18 +279,14 @@ class RNA_Workflow(object):
         if remove_identical:
             self.logger.info('Filtering identical sequences.')
 
-            seq_ids = list(seqs.keys())
-            for i in range(0, len(seq_ids)):
-                seq_id_I = seq_ids[i]
-
-                if seq_id_I in identical_seqs:
-                    continue
-
-                for j in range(i + 1, len(seqIds)):
-                    seq_id_J = seq_ids[j]
-                    if seqs[seq_id_I] == seqs[seq_id_J]:
-                      self.logger.info('Seq %s and %s are identical.' % (seq_id_I, seq_id_J))
-                      identical_seqs.add(seq_id_J)
+            # hash each sequence once instead of comparing all pairs
+            first_seq_id = {}
+            for seq_id, seq in seqs.items():
+                if seq in first_seq_id:
+                    self.logger.info('Seq %s and %s are identical.' % (first_seq_id[seq], seq_id))
+                    identical_seqs.add(seq_id)
+                else:
+                    first_seq_id[seq] = seq_id
 
             self.logger.info('Identified %d of %d sequences as identical.' % (len(identical_seqs), len(seqs)))
 
@@ -556,9 +551,16 @@ class RNA_Workflow(object):
                                                                       'scaffold_count',
                                                                       'n50_scaffolds',
                                                                       'organism_name',
-                                                                      'gtdb_representative'])
-
-        gtdb_taxonomy = read_gtdb_taxonomy(gtdb_metadata_file)
+                                                                      'gtdb_representative',
+                                                                      'gtdb_taxonomy'])
+
+        # get GTDB taxonomy from metadata rather than re-reading the metadata file
+        gtdb_taxonomy = {}
+        for genome_id, metadata in genome_metadata.items():
+            if metadata.gtdb_taxonomy:
+                gtdb_taxonomy[genome_id] = [t.strip() for t in metadata.gtdb_taxonomy.split(';')]
+            else:
+                gtdb_taxonomy[genome_id] = list(Taxonomy.rank_prefixes)
 
         user_genomes = set()
         uba_genomes = set()
@@ -601,7 +603,7 @@ class RNA_Workflow(object):
             self.logger.info('Filtering on number of contigs >%d.' % max_contigs)
             self.logger.info('Filtering on scaffold N50 <%d.' % min_N50)
             
-            new_genomes_to_consider = []
+            new_genomes_to_consider = set()
             filtered_genomes = 0
             gt = 0
             gq = 0
@@ -618,7 +620,7 @@ class RNA_Workflow(object):
                     filtered_genomes += 1
                     continue
                     
-                comp, cont, scaffold_count, n50_contigs, _org_name, _rep = genome_metadata[genome_id]
+                comp, cont, scaffold_count, n50_contigs, _org_name, _rep, _taxonomy = genome_metadata[genome_id]
                 q = float(comp) - 5*float(cont)
                 if q < min_quality or int(scaffold_count) > max_contigs or int(n50_contigs) < min_N50:
                     if q < min_quality:
@@ -633,7 +635,7 @@ class RNA_Workflow(object):
                     filtered_genomes += 1
                     continue
                     
-                new_genomes_to_consider.append(genome_id)
+                new_genomes_to_consider.add(genome_id)
 
             genomes_to_consider = new_genomes_to_consider
             self.logger.info('Filtered %d genomes (%d on genome type, %d on genome quality, %d on number of contigs, %d on N50).' % (filtered_genomes, gt, gq, sc, n50))
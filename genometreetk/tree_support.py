@@ -21,6 +21,8 @@ from math import floor
 
 import dendropy
 
+from genometreetk.common import subtree_leaf_ranges
+
 
 class TreeSupport():
     """Calculate support values for clades."""
@@ -47,6 +49,14 @@ class TreeSupport():
             node.label = 0
             node.nontrivial_splits = 0
 
+        # taxa below each internal node are independent of the replicate
+        # trees so only need to be determined once
+        leaf_labels, leaf_ranges = subtree_leaf_ranges(tree)
+        node_taxa = []
+        for node in tree.internal_nodes():
+            start, end = leaf_ranges[node]
+            node_taxa.append((node, set(leaf_labels[start:end])))
+
         for rep_tree_file in replicate_trees:
             rep_tree = dendropy.Tree.get_from_path(rep_tree_file, schema='newick', rooting='force-unrooted', preserve_underscores=True)
 
@@ -54,8 +64,8 @@ class TreeSupport():
 
             rep_tree_taxa_set = set([x.taxon.label for x in rep_tree.leaf_nodes()])
 
-            for i, node in enumerate(tree.internal_nodes()):
-                taxa_labels = set([x.taxon.label for x in node.leaf_nodes()]).intersection(rep_tree_taxa_set)
+            for node, taxa in node_taxa:
+                taxa_labels = taxa.intersection(rep_tree_taxa_set)
 
                 split = rep_tree.taxon_namespace.taxa_bitmask(labels=taxa_labels)
                 normalized_split = dendropy.Bipartition.normalize_bitmask(
@@ -73,8 +73,9 @@ class RunCheckm(object):
             
                 protein_file = protein_files[gid]
                 if os.path.exists(protein_file):
-                    cmd = 'ln -s %s %s' % (protein_file, os.path.join(protein_file_dir, gid + '_ncbi_proteins.faa'))
-                    os.system(cmd)
+                    link_file = os.path.join(protein_file_dir, gid + '_ncbi_proteins.faa')
+                    if not os.path.lexists(link_file):
+                        os.symlink(protein_file, link_file)
                 else:
                     print('Missing protein file for %s.' % gid)
 